@@ -36,6 +36,10 @@ class ModelArguments:
 
     sentence_pooling_method: str = field(default='cls')
     normlized: bool = field(default=False)
+    mixed_precision_dtype: str = field(
+        default='bfloat16',
+        metadata={"help": "autocast dtype for the contrastive forward: bfloat16, float16 or none"}
+    )
 
 
 @dataclass
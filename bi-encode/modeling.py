@@ -1,675 +1,814 @@
-import copy
-import json
-import logging
-import os
-from dataclasses import dataclass
-from typing import Dict, Optional
-
-import torch
-import torch.distributed as dist
-import torch.nn.functional as F
-from bi_encoder.arguments import ModelArguments, \
-    RetrieverTrainingArguments as TrainingArguments
-from torch import nn, Tensor
-from transformers import PreTrainedModel, AutoModel
-from transformers.file_utils import ModelOutput
-
-logger = logging.getLogger(__name__)
-
-
-@dataclass
-class EncoderOutput(ModelOutput):
-    q_reps: Optional[Tensor] = None
-    p_reps: Optional[Tensor] = None
-    loss: Optional[Tensor] = None
-    scores: Optional[Tensor] = None
-
-
-class DensePooler(nn.Module):
-    def __init__(self, input_dim: int = 768, output_dim: int = 768, tied=True):
-        super(DensePooler, self).__init__()
-        self.linear_q = nn.Linear(input_dim, output_dim)
-        if tied:
-            self.linear_p = self.linear_q
-        else:
-            self.linear_p = nn.Linear(input_dim, output_dim)
-        self._config = {'input_dim': input_dim, 'output_dim': output_dim, 'tied': tied}
-
-    def load(self, model_dir: str):
-        pooler_path = os.path.join(model_dir, 'pooler.pt')
-        if pooler_path is not None:
-            if os.path.exists(pooler_path):
-                logger.info(f'Loading Pooler from {pooler_path}')
-                state_dict = torch.load(pooler_path, map_location='cpu')
-                self.load_state_dict(state_dict)
-                return
-        logger.info("Training Pooler from scratch")
-        return
-
-    def save_pooler(self, save_path):
-        torch.save(self.state_dict(), os.path.join(save_path, 'pooler.pt'))
-        with open(os.path.join(save_path, 'pooler_config.json'), 'w') as f:
-            json.dump(self._config, f)
-
-    def forward(self, q: Tensor = None, p: Tensor = None, **kwargs):
-        if q is not None:
-            return self.linear_q(q)
-        elif p is not None:
-            return self.linear_p(p)
-        else:
-            raise ValueError
-
-
-class BiEncoderModel(nn.Module):
-    TRANSFORMER_CLS = AutoModel
-
-    def __init__(self,
-                 lm_q: PreTrainedModel,
-                 lm_p: PreTrainedModel,
-                 pooler: nn.Module = None,
-                 untie_encoder: bool = False,
-                 normlized: bool = False,
-                 sentence_pooling_method: str = 'cls',
-                 negatives_x_device: bool = False,
-                 temperature: float = 1.0,
-                 contrastive_loss_weight: float = 1.0,
-                 loss_type: str = "softmax",
-                 ):
-        super().__init__()
-        self.lm_q = lm_q
-        self.lm_p = lm_p
-        self.pooler = pooler
-        self.cross_entropy = nn.CrossEntropyLoss(reduction='mean')
-        self.kl = nn.KLDivLoss(reduction="mean")
-        self.untie_encoder = untie_encoder
-
-        self.normlized = normlized
-        self.sentence_pooling_method = sentence_pooling_method
-        self.temperature = temperature
-        self.loss_type = loss_type
-        # print(self.loss_type)
-        self.negatives_x_device = negatives_x_device
-        self.contrastive_loss_weight = contrastive_loss_weight
-        if self.negatives_x_device:
-            if not dist.is_initialized():
-                raise ValueError('Distributed training has not been initialized for representation all gather.')
-            self.process_rank = dist.get_rank()
-            self.world_size = dist.get_world_size()
-
-    def sentence_embedding(self, hidden_state, mask):
-        if self.sentence_pooling_method == 'mean':  # 使用所有token的平均值
-            s = torch.sum(hidden_state * mask.unsqueeze(-1).float(), dim=1)
-            d = mask.sum(axis=1, keepdim=True).float()  # 计算每个句子的长度
-            return s / d
-        elif self.sentence_pooling_method == 'cls':  # 使用cls token
-            return hidden_state[:, 0]
-
-    def encode_passage(self, psg):
-        if psg is None:
-            return None
-        psg_out = self.lm_p(**psg, return_dict=True)
-        p_hidden = psg_out.last_hidden_state  # 取出最后一层的hidden state B * N * D
-        p_reps = self.sentence_embedding(p_hidden, psg['attention_mask'])
-        if self.pooler is not None:
-            p_reps = self.pooler(p=p_reps)  # D * d
-        if self.normlized:
-            p_reps = torch.nn.functional.normalize(p_reps, dim=-1)
-        return p_reps.contiguous()
-
-    def encode_query(self, qry):
-        if qry is None:
-            return None
-        qry_out = self.lm_q(**qry, return_dict=True)
-        q_hidden = qry_out.last_hidden_state
-        q_reps = self.sentence_embedding(q_hidden, qry['attention_mask'])
-        if self.pooler is not None:
-            q_reps = self.pooler(q=q_reps)
-        if self.normlized:
-            q_reps = torch.nn.functional.normalize(q_reps, dim=-1)
-        return q_reps.contiguous()
-
-    def compute_similarity(self, q_reps, p_reps):
-        if len(p_reps.size()) == 2:  # 如果是单个句子，即没有batch维度
-            return torch.matmul(q_reps, p_reps.transpose(0, 1))
-        return torch.matmul(q_reps, p_reps.transpose(-2, -1))
-
-    @staticmethod
-    def load_pooler(model_weights_file, **config):
-        pooler = DensePooler(**config)
-        pooler.load(model_weights_file)
-        return pooler
-
-    @staticmethod
-    def build_pooler(model_args):
-        pooler = DensePooler(
-            model_args.projection_in_dim,
-            model_args.projection_out_dim,
-            tied=not model_args.untie_encoder
-        )
-        pooler.load(model_args.model_name_or_path)
-        return pooler
-    def compute_loss(self, scores, target):        
-        if self.loss_type == 'softmax':
-            return self.cross_entropy(scores, target)
-        elif self.loss_type == 'multi-softmax':  # L2 loss
-            # 多个正例的cross entropy, scores: B*C, target: B*C
-            cross_entropy_batch = nn.CrossEntropyLoss(reduction='none')
-            loss = cross_entropy_batch(scores, target.float())
-            if (loss != 0.0).int().sum() == 0:  # batch内都是0
-                return 0 * loss.sum()
-            else:
-                loss = loss.sum() / (loss != 0.0).int().sum()  # 针对样本数量取均值
-                return loss
-        elif self.loss_type == 'myloss':  # L3 loss
-            # loss = -log(sum(exp(positives) / sum(exp(all)))
-            # target indicates the position of positive samples, 1 for positive, 0 for negative
-            valid_mask = target.sum(dim=1) > 0
-            valid_scores = scores[valid_mask]
-            valid_target = target[valid_mask]
-            if valid_scores.size(0) == 0:
-                return torch.tensor(0.0, device=scores.device, requires_grad=True)
-            
-            valid_target = valid_target.float()  # TODO: 根据是binary的标签还是210的标签选择是否除2
-            soft_scores = F.softmax(valid_scores, dim=-1)
-            sum_positives = torch.sum(soft_scores * valid_target, dim=-1)
-            sum_positives = torch.clamp(sum_positives, min=1e-9, max=1.0)
-            
-            log_sum_scores = -torch.log(sum_positives)
-            loss = torch.mean(log_sum_scores)
-            return loss
-        else:
-            assert 1 > 2
-    def forward(self, query: Dict[str, Tensor] = None, passage: Dict[str, Tensor] = None, teacher_score: Tensor = None):
-        q_reps = self.encode_query(query)
-        p_reps = self.encode_passage(passage)
-        # print(teacher_score)
-        # assert 1 > 2
-        # if self.loss_type == "multi-softma" or "myloss":
-        # assert teacher_score == None
-        # for inference
-        if q_reps is None or p_reps is None:  # 如果有一个为None，说明是用模型来编码
-            return EncoderOutput(
-                q_reps=q_reps,
-                p_reps=p_reps,
-                loss=None,
-                scores=None
-            )
-
-        if self.training:
-            kl_loss = 0.0
-            if teacher_score is not None:
-                if self.negatives_x_device:
-                    q_reps = self._dist_gather_tensor(q_reps)
-                    p_reps = self._dist_gather_tensor(p_reps)
-                    teacher_score = self._dist_gather_tensor(teacher_score)
-                        
-                scores = self.compute_similarity(q_reps, p_reps)
-                scores = scores / self.temperature
-                scores = scores.view(q_reps.size(0), -1)
-                
-                # 多个正样本，每个query的正负样本由teacher score指出
-                target = torch.zeros_like(scores, device=scores.device, dtype=torch.float32)
-                # 填充标签
-                B, N = teacher_score.shape
-                indices = torch.arange(B, device=scores.device).unsqueeze(1) * N + torch.arange(N, device=scores.device)
-                target = target.scatter_(1, indices, teacher_score)
-
-                loss = self.compute_loss(scores, target)
-            else:
-                if self.negatives_x_device:
-                    q_reps = self._dist_gather_tensor(q_reps)
-                    p_reps = self._dist_gather_tensor(p_reps)
-
-                scores = self.compute_similarity(q_reps, p_reps)
-                scores = scores / self.temperature
-                scores = scores.view(q_reps.size(0), -1)
-
-                target = torch.arange(scores.size(0), device=scores.device, dtype=torch.long)
-                target = target * (p_reps.size(0) // q_reps.size(0))
-
-                loss = self.compute_loss(scores, target)
-        else:
-            scores = self.compute_similarity(q_reps, p_reps)
-            loss = None
-        return EncoderOutput(
-            loss=loss,
-            scores=scores,
-            q_reps=q_reps,
-            p_reps=p_reps,
-        )
-
-    # def compute_loss(self, scores, target):
-    #     return self.cross_entropy(scores, target)
-
-    def _dist_gather_tensor(self, t: Optional[torch.Tensor]):
-        if t is None:
-            return None
-        t = t.contiguous()
-
-        all_tensors = [torch.empty_like(t) for _ in range(self.world_size)]  # 进程数个tensor
-        dist.all_gather(all_tensors, t)  # 将每个进程的tensor收集到all_tensors中
-
-        all_tensors[self.process_rank] = t  # 将当前进程的tensor放到对应的位置
-        all_tensors = torch.cat(all_tensors, dim=0)  # 拼接所有的tensor
-
-        return all_tensors
-
-    @classmethod
-    def build(
-            cls,
-            model_args: ModelArguments,
-            train_args: TrainingArguments,
-            **hf_kwargs,
-    ):
-        # load local
-        if os.path.isdir(model_args.model_name_or_path):
-            if model_args.untie_encoder:
-
-                _qry_model_path = os.path.join(model_args.model_name_or_path, 'query_model')
-                _psg_model_path = os.path.join(model_args.model_name_or_path, 'passage_model')
-                if not os.path.exists(_qry_model_path):
-                    _qry_model_path = model_args.model_name_or_path
-                    _psg_model_path = model_args.model_name_or_path
-                logger.info(f'loading query model weight from {_qry_model_path}')
-                lm_q = cls.TRANSFORMER_CLS.from_pretrained(
-                    _qry_model_path,
-                    **hf_kwargs
-                )
-                logger.info(f'loading passage model weight from {_psg_model_path}')
-                lm_p = cls.TRANSFORMER_CLS.from_pretrained(
-                    _psg_model_path,
-                    **hf_kwargs
-                )
-            else:
-                lm_q = cls.TRANSFORMER_CLS.from_pretrained(model_args.model_name_or_path, **hf_kwargs)
-                lm_p = lm_q
-        # load pre-trained
-        else:
-            lm_q = cls.TRANSFORMER_CLS.from_pretrained(model_args.model_name_or_path, **hf_kwargs)
-            lm_p = copy.deepcopy(lm_q) if model_args.untie_encoder else lm_q
-
-        if model_args.add_pooler:
-            pooler = cls.build_pooler(model_args)
-        else:
-            pooler = None
-
-        model = cls(
-            lm_q=lm_q,
-            lm_p=lm_p,
-            pooler=pooler,
-            negatives_x_device=train_args.negatives_x_device,
-            untie_encoder=model_args.untie_encoder,
-            normlized=model_args.normlized,
-            sentence_pooling_method=model_args.sentence_pooling_method,
-            temperature=train_args.temperature,
-            contrastive_loss_weight=train_args.contrastive_loss_weight,
-            loss_type=train_args.loss_type
-        )
-        return model
-
-    @classmethod
-    def load(
-            cls,
-            model_name_or_path,
-            normlized,
-            sentence_pooling_method,
-            **hf_kwargs,
-    ):
-        # load local
-        untie_encoder = True
-        if os.path.isdir(model_name_or_path):
-            _qry_model_path = os.path.join(model_name_or_path, 'query_model')
-            _psg_model_path = os.path.join(model_name_or_path, 'passage_model')
-            if os.path.exists(_qry_model_path):
-                logger.info(f'found separate weight for query/passage encoders')
-                logger.info(f'loading query model weight from {_qry_model_path}')
-                lm_q = cls.TRANSFORMER_CLS.from_pretrained(
-                    _qry_model_path,
-                    **hf_kwargs
-                )
-                logger.info(f'loading passage model weight from {_psg_model_path}')
-                lm_p = cls.TRANSFORMER_CLS.from_pretrained(
-                    _psg_model_path,
-                    **hf_kwargs
-                )
-                untie_encoder = False
-            else:
-                logger.info(f'try loading tied weight')
-                logger.info(f'loading model weight from {model_name_or_path}')
-                lm_q = cls.TRANSFORMER_CLS.from_pretrained(model_name_or_path, **hf_kwargs)
-                lm_p = lm_q
-        else:
-            logger.info(f'try loading tied weight')
-            logger.info(f'loading model weight from {model_name_or_path}')
-            lm_q = cls.TRANSFORMER_CLS.from_pretrained(model_name_or_path, **hf_kwargs)
-            lm_p = lm_q
-
-        pooler_weights = os.path.join(model_name_or_path, 'pooler.pt')
-        pooler_config = os.path.join(model_name_or_path, 'pooler_config.json')
-        if os.path.exists(pooler_weights) and os.path.exists(pooler_config):
-            logger.info(f'found pooler weight and configuration')
-            with open(pooler_config) as f:
-                pooler_config_dict = json.load(f)
-            pooler = cls.load_pooler(model_name_or_path, **pooler_config_dict)
-        else:
-            pooler = None
-
-        model = cls(
-            lm_q=lm_q,
-            lm_p=lm_p,
-            pooler=pooler,
-            untie_encoder=untie_encoder,
-            normlized=normlized,
-            sentence_pooling_method=sentence_pooling_method,
-        )
-        return model
-
-    def save(self, output_dir: str):
-        if self.untie_encoder:
-            os.makedirs(os.path.join(output_dir, 'query_model'))
-            os.makedirs(os.path.join(output_dir, 'passage_model'))
-            self.lm_q.save_pretrained(os.path.join(output_dir, 'query_model'))
-            self.lm_p.save_pretrained(os.path.join(output_dir, 'passage_model'))
-        else:
-            self.lm_q.save_pretrained(output_dir)
-        if self.pooler:
-            self.pooler.save_pooler(output_dir)
-
-
-class MultiBiEncoderModel(nn.Module):
-    TRANSFORMER_CLS = AutoModel
-
-    def __init__(self,
-                 lm_q: PreTrainedModel,
-                 lm_p: PreTrainedModel,
-                 pooler: nn.Module = None,
-                 untie_encoder: bool = False,
-                 normlized: bool = False,
-                 sentence_pooling_method: str = 'cls',
-                 negatives_x_device: bool = False,
-                 temperature: float = 1.0,
-                 contrastive_loss_weight: float = 1.0
-                 ):
-        super().__init__()
-        self.lm_q = lm_q
-        self.lm_p = lm_p
-        self.pooler = pooler
-        self.loss_func = nn.HingeEmbeddingLoss(margin=0.5, reduction='mean')
-        self.kl = nn.KLDivLoss(reduction="mean")
-        self.untie_encoder = untie_encoder
-
-        self.normlized = normlized
-        self.sentence_pooling_method = sentence_pooling_method
-        self.temperature = temperature
-        self.negatives_x_device = negatives_x_device
-        self.contrastive_loss_weight = contrastive_loss_weight
-        if self.negatives_x_device:
-            if not dist.is_initialized():
-                raise ValueError('Distributed training has not been initialized for representation all gather.')
-            self.process_rank = dist.get_rank()
-            self.world_size = dist.get_world_size()
-
-    def sentence_embedding(self, hidden_state, mask):
-        if self.sentence_pooling_method == 'mean':  # 使用所有token的平均值
-            s = torch.sum(hidden_state * mask.unsqueeze(-1).float(), dim=1)
-            d = mask.sum(axis=1, keepdim=True).float()  # 计算每个句子的长度
-            return s / d
-        elif self.sentence_pooling_method == 'cls':  # 使用cls token
-            return hidden_state[:, 0]
-
-    def encode_passage(self, psg):
-        if psg is None:
-            return None
-        psg_out = self.lm_p(**psg, return_dict=True)
-        p_hidden = psg_out.last_hidden_state  # 取出最后一层的hidden state B * N * D
-        p_reps = self.sentence_embedding(p_hidden, psg['attention_mask'])
-        if self.pooler is not None:
-            p_reps = self.pooler(p=p_reps)  # D * d
-        if self.normlized:
-            p_reps = torch.nn.functional.normalize(p_reps, dim=-1)
-        return p_reps.contiguous()
-
-    def encode_query(self, qry):
-        if qry is None:
-            return None
-        qry_out = self.lm_q(**qry, return_dict=True)
-        q_hidden = qry_out.last_hidden_state
-        q_reps = self.sentence_embedding(q_hidden, qry['attention_mask'])
-        if self.pooler is not None:
-            q_reps = self.pooler(q=q_reps)
-        if self.normlized:
-            q_reps = torch.nn.functional.normalize(q_reps, dim=-1)
-        return q_reps.contiguous()
-
-    def compute_similarity(self, q_reps, p_reps):
-        if len(p_reps.size()) == 2:  # 如果是单个句子，即没有batch维度
-            return torch.matmul(q_reps, p_reps.transpose(0, 1))
-        return torch.matmul(q_reps, p_reps.transpose(-2, -1))
-
-    @staticmethod
-    def load_pooler(model_weights_file, **config):
-        pooler = DensePooler(**config)
-        pooler.load(model_weights_file)
-        return pooler
-
-    @staticmethod
-    def build_pooler(model_args):
-        pooler = DensePooler(
-            model_args.projection_in_dim,
-            model_args.projection_out_dim,
-            tied=not model_args.untie_encoder
-        )
-        pooler.load(model_args.model_name_or_path)
-        return pooler
-
-    def forward(self, query: Dict[str, Tensor] = None, passage: Dict[str, Tensor] = None, teacher_score: Tensor = None):
-        q_reps = self.encode_query(query)
-        p_reps = self.encode_passage(passage)
-
-        # for inference
-        if q_reps is None or p_reps is None:  # 如果有一个为None，说明是用模型来编码
-            return EncoderOutput(
-                q_reps=q_reps,
-                p_reps=p_reps,
-                loss=None,
-                scores=None
-            )
-
-        if self.training:
-            if self.negatives_x_device:
-                q_reps = self._dist_gather_tensor(q_reps)
-                p_reps = self._dist_gather_tensor(p_reps)
-
-            scores = self.compute_similarity(q_reps, p_reps)
-            scores = scores / self.temperature
-            scores = scores.view(q_reps.size(0), -1)
-
-            # 多个正样本，每个query的正负样本由teacher score指出
-            target = torch.zeros_like(scores, device=scores.device, dtype=torch.float32)
-            # 填充标签
-            B, N = teacher_score.shape
-            indices = torch.arange(B, device=scores.device).unsqueeze(1) * N + torch.arange(N, device=scores.device)
-            target = target.scatter_(1, indices, teacher_score)
-            # # 设置正负样本的weight为比例的倒数，正样本为总数除以正样本数，负样本为总数除以负样本数
-            # weights = torch.ones_like(target, device=scores.device)
-            # for i in range(weights.size(0)):
-            #     num_positives = torch.sum(target[i])
-            #     num_negatives = weights.size(1) - num_positives
-            #     if num_positives > 0:
-            #         weights[i][target[i] == 1] = weights.size(1) / num_positives
-            #     if num_negatives > 0:
-            #         weights[i][target[i] == 0] = weights.size(1) / num_negatives
-
-            loss = self.compute_loss(scores, target)
-
-        else:
-            scores = self.compute_similarity(q_reps, p_reps)
-            loss = None
-        return EncoderOutput(
-            loss=loss,
-            scores=scores,
-            q_reps=q_reps,
-            p_reps=p_reps,
-        )
-
-    def compute_loss(self, scores, target, weights=None):
-        # scores: B * (B * N), target: B * (B * N)
-        # loss = nn.BCEWithLogitsLoss(weight=weights)(scores, target)
-
-        # loss = -log(sum(exp(positives) / sum(exp(all)))
-        # target indicates the position of positive samples, 1 for positive, 0 for negative
-        # valid_mask = target.sum(dim=1) > 0
-        # valid_scores = scores[valid_mask]
-        # valid_target = target[valid_mask]
-        # if valid_scores.size(0) == 0:
-        #     return torch.tensor(0.0, device=scores.device, requires_grad=True)
-
-        # soft_scores = F.softmax(valid_scores, dim=-1)
-        # sum_positives = torch.sum(soft_scores * valid_target, dim=-1)
-        # log_sum_scores = -torch.log(sum_positives)
-        # loss = torch.mean(log_sum_scores)
-
-        # hinge embedding loss
-        target = target * 2 - 1
-        target = target.flatten()
-
-        distance = 1 - scores
-        distance = distance.flatten()
-
-        loss = self.loss_func(distance, target)
-
-        return loss
-    
-    def _dist_gather_tensor(self, t: Optional[torch.Tensor]):
-        if t is None:
-            return None
-        t = t.contiguous()
-
-        all_tensors = [torch.empty_like(t) for _ in range(self.world_size)]  # 进程数个tensor
-        dist.all_gather(all_tensors, t)  # 将每个进程的tensor收集到all_tensors中
-
-        all_tensors[self.process_rank] = t  # 将当前进程的tensor放到对应的位置
-        all_tensors = torch.cat(all_tensors, dim=0)  # 拼接所有的tensor
-
-        return all_tensors
-
-    @classmethod
-    def build(
-            cls,
-            model_args: ModelArguments,
-            train_args: TrainingArguments,
-            **hf_kwargs,
-    ):
-        # load local
-        if os.path.isdir(model_args.model_name_or_path):
-            if model_args.untie_encoder:
-
-                _qry_model_path = os.path.join(model_args.model_name_or_path, 'query_model')
-                _psg_model_path = os.path.join(model_args.model_name_or_path, 'passage_model')
-                if not os.path.exists(_qry_model_path):
-                    _qry_model_path = model_args.model_name_or_path
-                    _psg_model_path = model_args.model_name_or_path
-                logger.info(f'loading query model weight from {_qry_model_path}')
-                lm_q = cls.TRANSFORMER_CLS.from_pretrained(
-                    _qry_model_path,
-                    **hf_kwargs
-                )
-                logger.info(f'loading passage model weight from {_psg_model_path}')
-                lm_p = cls.TRANSFORMER_CLS.from_pretrained(
-                    _psg_model_path,
-                    **hf_kwargs
-                )
-            else:
-                lm_q = cls.TRANSFORMER_CLS.from_pretrained(model_args.model_name_or_path, **hf_kwargs)
-                lm_p = lm_q
-        # load pre-trained
-        else:
-            lm_q = cls.TRANSFORMER_CLS.from_pretrained(model_args.model_name_or_path, **hf_kwargs)
-            lm_p = copy.deepcopy(lm_q) if model_args.untie_encoder else lm_q
-
-        if model_args.add_pooler:
-            pooler = cls.build_pooler(model_args)
-        else:
-            pooler = None
-
-        model = cls(
-            lm_q=lm_q,
-            lm_p=lm_p,
-            pooler=pooler,
-            negatives_x_device=train_args.negatives_x_device,
-            untie_encoder=model_args.untie_encoder,
-            normlized=model_args.normlized,
-            sentence_pooling_method=model_args.sentence_pooling_method,
-            temperature=train_args.temperature,
-            contrastive_loss_weight=train_args.contrastive_loss_weight,
-            loss_type=train_args.loss_type
-        )
-        return model
-
-    @classmethod
-    def load(
-            cls,
-            model_name_or_path,
-            normlized,
-            sentence_pooling_method,
-            **hf_kwargs,
-    ):
-        # load local
-        untie_encoder = True
-        if os.path.isdir(model_name_or_path):
-            _qry_model_path = os.path.join(model_name_or_path, 'query_model')
-            _psg_model_path = os.path.join(model_name_or_path, 'passage_model')
-            if os.path.exists(_qry_model_path):
-                logger.info(f'found separate weight for query/passage encoders')
-                logger.info(f'loading query model weight from {_qry_model_path}')
-                lm_q = cls.TRANSFORMER_CLS.from_pretrained(
-                    _qry_model_path,
-                    **hf_kwargs
-                )
-                logger.info(f'loading passage model weight from {_psg_model_path}')
-                lm_p = cls.TRANSFORMER_CLS.from_pretrained(
-                    _psg_model_path,
-                    **hf_kwargs
-                )
-                untie_encoder = False
-            else:
-                logger.info(f'try loading tied weight')
-                logger.info(f'loading model weight from {model_name_or_path}')
-                lm_q = cls.TRANSFORMER_CLS.from_pretrained(model_name_or_path, **hf_kwargs)
-                lm_p = lm_q
-        else:
-            logger.info(f'try loading tied weight')
-            logger.info(f'loading model weight from {model_name_or_path}')
-            lm_q = cls.TRANSFORMER_CLS.from_pretrained(model_name_or_path, **hf_kwargs)
-            lm_p = lm_q
-
-        pooler_weights = os.path.join(model_name_or_path, 'pooler.pt')
-        pooler_config = os.path.join(model_name_or_path, 'pooler_config.json')
-        if os.path.exists(pooler_weights) and os.path.exists(pooler_config):
-            logger.info(f'found pooler weight and configuration')
-            with open(pooler_config) as f:
-                pooler_config_dict = json.load(f)
-            pooler = cls.load_pooler(model_name_or_path, **pooler_config_dict)
-        else:
-            pooler = None
-
-        model = cls(
-            lm_q=lm_q,
-            lm_p=lm_p,
-            pooler=pooler,
-            untie_encoder=untie_encoder,
-            normlized=normlized,
-            sentence_pooling_method=sentence_pooling_method,
-        )
-        return model
-
-    def save(self, output_dir: str):
-        if self.untie_encoder:
-            os.makedirs(os.path.join(output_dir, 'query_model'))
-            os.makedirs(os.path.join(output_dir, 'passage_model'))
-            self.lm_q.save_pretrained(os.path.join(output_dir, 'query_model'))
-            self.lm_p.save_pretrained(os.path.join(output_dir, 'passage_model'))
-        else:
-            self.lm_q.save_pretrained(output_dir)
-        if self.pooler:
-            self.pooler.save_pooler(output_dir)
+import json
+import logging
+import os
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from bi_encoder.arguments import ModelArguments, \
+    RetrieverTrainingArguments as TrainingArguments
+from safetensors.torch import load_file as load_safetensors, save_file as save_safetensors
+from torch import nn, Tensor
+from transformers import PreTrainedModel, AutoModel
+from transformers.file_utils import ModelOutput
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class EncoderOutput(ModelOutput):
+    q_reps: Optional[Tensor] = None
+    p_reps: Optional[Tensor] = None
+    loss: Optional[Tensor] = None
+    scores: Optional[Tensor] = None
+
+
+class DensePooler(nn.Module):
+    def __init__(self, input_dim: int = 768, output_dim: int = 768, tied=True):
+        super(DensePooler, self).__init__()
+        self.linear_q = nn.Linear(input_dim, output_dim)
+        if tied:
+            self.linear_p = self.linear_q
+        else:
+            self.linear_p = nn.Linear(input_dim, output_dim)
+        self._config = {'input_dim': input_dim, 'output_dim': output_dim, 'tied': tied}
+
+    def load(self, model_dir: str):
+        # 优先读safetensors：mmap零拷贝加载，不走pickle；老的pooler.pt作为fallback
+        safetensors_path = os.path.join(model_dir, 'pooler.safetensors')
+        if os.path.exists(safetensors_path):
+            logger.info(f'Loading Pooler from {safetensors_path}')
+            self.load_state_dict(load_safetensors(safetensors_path, device='cpu'))
+            return
+        pooler_path = os.path.join(model_dir, 'pooler.pt')
+        if pooler_path is not None:
+            if os.path.exists(pooler_path):
+                logger.info(f'Loading Pooler from {pooler_path}')
+                state_dict = torch.load(pooler_path, map_location='cpu')
+                self.load_state_dict(state_dict)
+                return
+        logger.info("Training Pooler from scratch")
+        return
+
+    def save_pooler(self, save_path):
+        # safetensors拒绝共享storage的tensor，tied时linear_p/linear_q同权重，clone解开
+        state_dict = {k: v.clone() for k, v in self.state_dict().items()}
+        save_safetensors(state_dict, os.path.join(save_path, 'pooler.safetensors'))
+        with open(os.path.join(save_path, 'pooler_config.json'), 'w') as f:
+            json.dump(self._config, f)
+
+    def quantize_for_inference(self):
+        # 推理时pooler的Linear是memory-bound的小GEMM/GEMV，动态量化成INT8权重带宽减半，
+        # CPU上走FBGEMM的VNNI int8点积指令
+        torch.ao.quantization.quantize_dynamic(self, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        if self._config['tied']:
+            self.linear_p = self.linear_q  # 量化会逐个替换子模块，重新tie避免留两份权重
+        return self
+
+    def forward(self, q: Tensor = None, p: Tensor = None, **kwargs):
+        if q is not None:
+            return self.linear_q(q)
+        elif p is not None:
+            return self.linear_p(p)
+        else:
+            raise ValueError
+
+
+class BiEncoderModel(nn.Module):
+    TRANSFORMER_CLS = AutoModel
+
+    def __init__(self,
+                 lm_q: PreTrainedModel,
+                 lm_p: PreTrainedModel,
+                 pooler: nn.Module = None,
+                 untie_encoder: bool = False,
+                 normlized: bool = False,
+                 sentence_pooling_method: str = 'cls',
+                 negatives_x_device: bool = False,
+                 temperature: float = 1.0,
+                 contrastive_loss_weight: float = 1.0,
+                 loss_type: str = "softmax",
+                 mixed_precision_dtype: Optional[torch.dtype] = torch.bfloat16,
+                 gradient_checkpointing: bool = False,
+                 fuse_normalize_into_scores: bool = False,
+                 use_compile: bool = False,
+                 ):
+        super().__init__()
+        self.lm_q = lm_q
+        self.lm_p = lm_p
+        self.pooler = pooler
+        self.cross_entropy = nn.CrossEntropyLoss(reduction='mean')
+        self.cross_entropy_none = nn.CrossEntropyLoss(reduction='none')
+        self.kl = nn.KLDivLoss(reduction="mean")
+        self.untie_encoder = untie_encoder
+
+        self.normlized = normlized
+        self.sentence_pooling_method = sentence_pooling_method
+        self.temperature = temperature
+        self.inv_temperature = 1.0 / temperature
+        self.loss_type = loss_type
+        self.mixed_precision_dtype = mixed_precision_dtype  # None表示关闭autocast
+        self.fuse_normalize_into_scores = fuse_normalize_into_scores
+        # print(self.loss_type)
+        self.negatives_x_device = negatives_x_device
+        self.contrastive_loss_weight = contrastive_loss_weight
+        if self.negatives_x_device:
+            if not dist.is_initialized():
+                raise ValueError('Distributed training has not been initialized for representation all gather.')
+            self.process_rank = dist.get_rank()
+            self.world_size = dist.get_world_size()
+            self._gather_cache = {}  # 按(role, shape, dtype)缓存gather buffer，batch shape固定时零分配
+            self._gather_inflight = set()  # 还没wait的gather对应的key，防止buffer被并发collective复用
+        if gradient_checkpointing:
+            self.gradient_checkpointing_enable()
+        if use_compile:
+            # pooling/normalize/matmul/loss这串小kernel正是Inductor擅长融合的；
+            # 只编译encoder之后的尾巴，HF前向里的graph break不会拖累编译
+            self._contrastive_tail = torch.compile(self._contrastive_tail, mode='reduce-overhead', dynamic=True)
+
+    def gradient_checkpointing_enable(self, **kwargs):
+        # 用重算换激活显存，省下来的显存可以放更大的batch（每步更多in-batch负例）
+        self.lm_q.gradient_checkpointing_enable(**kwargs)
+        if self.untie_encoder:
+            self.lm_p.gradient_checkpointing_enable(**kwargs)
+        # checkpointing与KV cache不兼容，关掉以避免HF的warning和多余的cache分配
+        self.lm_q.config.use_cache = False
+        self.lm_p.config.use_cache = False
+
+    def sentence_embedding(self, hidden_state, mask):
+        if self.sentence_pooling_method == 'mean':  # 使用所有token的平均值
+            # einsum直接做带mask的求和，不会materialize B*N*D的临时tensor
+            s = torch.einsum('bnd,bn->bd', hidden_state, mask.to(hidden_state.dtype))
+            # 计算每个句子的长度；长度和倒数保持fp32（bf16下>256的整数不可精确表示），乘回时再回到激活精度
+            d = mask.sum(dim=1, keepdim=True).clamp_min(1).float()
+            return s * d.reciprocal().to(hidden_state.dtype)
+        elif self.sentence_pooling_method == 'cls':  # 使用cls token
+            return hidden_state[:, 0]
+
+    def encode_passage(self, psg, skip_normalize: bool = False):
+        if psg is None:
+            return None
+        psg_out = self.lm_p(**psg, return_dict=True)
+        p_hidden = psg_out.last_hidden_state  # 取出最后一层的hidden state B * N * D
+        p_reps = self.sentence_embedding(p_hidden, psg['attention_mask'])
+        if self.pooler is not None:
+            p_reps = self.pooler(p=p_reps)  # D * d
+        if self.normlized and not skip_normalize:
+            p_reps = torch.nn.functional.normalize(p_reps, dim=-1)
+        # normalize/pooler的输出本身就是连续的，避免无条件contiguous引入一次全量拷贝
+        return p_reps if p_reps.is_contiguous() else p_reps.contiguous()
+
+    def encode_query(self, qry, skip_normalize: bool = False):
+        if qry is None:
+            return None
+        qry_out = self.lm_q(**qry, return_dict=True)
+        q_hidden = qry_out.last_hidden_state
+        q_reps = self.sentence_embedding(q_hidden, qry['attention_mask'])
+        if self.pooler is not None:
+            q_reps = self.pooler(q=q_reps)
+        if self.normlized and not skip_normalize:
+            q_reps = torch.nn.functional.normalize(q_reps, dim=-1)
+        return q_reps if q_reps.is_contiguous() else q_reps.contiguous()
+
+    def encode_joint(self, qry, psg, skip_normalize: bool = False):
+        # lm_q is lm_p时把query和passage拼成一个batch只跑一次transformer前向：
+        # 每层一个大GEMM代替两个小GEMM，kernel launch数减半，tensor core利用率更高
+        num_query = qry['input_ids'].size(0)
+        max_len = max(qry['input_ids'].size(1), psg['input_ids'].size(1))
+        # 右侧pad 0补齐到公共长度；attention_mask同样补0，pad位置不参与attention和pooling
+        combined = {
+            k: torch.cat([F.pad(qry[k], (0, max_len - qry[k].size(1))),
+                          F.pad(psg[k], (0, max_len - psg[k].size(1)))], dim=0)
+            for k in qry if k in psg
+        }
+        out = self.lm_q(**combined, return_dict=True)
+        hidden = out.last_hidden_state
+        q_reps = self.sentence_embedding(hidden[:num_query], combined['attention_mask'][:num_query])
+        p_reps = self.sentence_embedding(hidden[num_query:], combined['attention_mask'][num_query:])
+        if self.pooler is not None:
+            q_reps = self.pooler(q=q_reps)
+            p_reps = self.pooler(p=p_reps)
+        if self.normlized and not skip_normalize:
+            q_reps = torch.nn.functional.normalize(q_reps, dim=-1)
+            p_reps = torch.nn.functional.normalize(p_reps, dim=-1)
+        q_reps = q_reps if q_reps.is_contiguous() else q_reps.contiguous()
+        p_reps = p_reps if p_reps.is_contiguous() else p_reps.contiguous()
+        return q_reps, p_reps
+
+    def compute_similarity(self, q_reps, p_reps):
+        if len(p_reps.size()) == 2:  # 如果是单个句子，即没有batch维度
+            # 直接走mm的gemm路径，BLAS原生支持转置的RHS，不会退化到bmm
+            return torch.mm(q_reps, p_reps.t())
+        return torch.matmul(q_reps, p_reps.transpose(-2, -1))
+
+    @staticmethod
+    def load_pooler(model_weights_file, **config):
+        pooler = DensePooler(**config)
+        pooler.load(model_weights_file)
+        return pooler
+
+    @staticmethod
+    def build_pooler(model_args):
+        pooler = DensePooler(
+            model_args.projection_in_dim,
+            model_args.projection_out_dim,
+            tied=not model_args.untie_encoder
+        )
+        pooler.load(model_args.model_name_or_path)
+        return pooler
+    def compute_loss(self, scores, target):
+        if self.loss_type == 'softmax':
+            return self.cross_entropy(scores, target)
+        elif self.loss_type == 'multi-softmax':  # L2 loss
+            # 多个正例的cross entropy, scores: B*C, target: B*C
+            loss = self.cross_entropy_none(scores, target.float())
+            # 针对非零样本数量取均值；batch内都是0时分母clamp到1，结果仍为0，无需分支
+            return loss.sum() / loss.ne(0.0).sum().clamp_min(1)
+        elif self.loss_type == 'myloss':  # L3 loss
+            # loss = -log(sum(exp(positives) / sum(exp(all)))
+            # target indicates the position of positive samples, 1 for positive, 0 for negative
+            # -log(sum_pos / sum_all) = logsumexp(all) - logsumexp(positives)
+            # 全程保持B×(B*N)的静态shape：scores[valid_mask]的动态索引会多一次压缩拷贝，
+            # 还会让CUDA graph capture失效。无正例的行把整行当作正例，
+            # 两个logsumexp相等，loss与梯度都精确为0，再按有效行数取均值
+            valid_mask = target.sum(dim=1) > 0
+            positive = (target != 0) | ~valid_mask.unsqueeze(1)
+            per_row = torch.logsumexp(scores, dim=-1) \
+                - torch.logsumexp(scores.masked_fill(~positive, float('-inf')), dim=-1)
+            return per_row.sum() / valid_mask.sum().clamp_min(1)
+        else:
+            assert 1 > 2
+    def forward(self, query: Dict[str, Tensor] = None, passage: Dict[str, Tensor] = None, teacher_score: Tensor = None):
+        # 训练时encoder前向和相似度矩阵在低精度下算（激活显存减半，tensor core矩阵乘更快），loss回到FP32
+        # pre-Ampere卡不支持bf16 autocast（进context就会RuntimeError），不支持时自动关掉
+        amp_enabled = (self.training and self.mixed_precision_dtype is not None and torch.cuda.is_available()
+                       and (self.mixed_precision_dtype != torch.bfloat16 or torch.cuda.is_bf16_supported()))
+        # 归一化折到score矩阵上时，encode先输出未归一化的表示，事后用rsqrt范数外积补上
+        fuse_norm = self.fuse_normalize_into_scores and self.normlized and self.training
+        with torch.autocast(device_type='cuda', dtype=self.mixed_precision_dtype or torch.bfloat16,
+                            enabled=amp_enabled):
+            # 用权重是否真的共享来判断，load()里untie_encoder的含义是反的，不能信
+            if query is not None and passage is not None and self.lm_q is self.lm_p:
+                # 共享权重时query/passage拼成一个batch，省掉一整次transformer前向的launch开销
+                q_reps, p_reps = self.encode_joint(query, passage, skip_normalize=fuse_norm)
+            else:
+                q_reps = self.encode_query(query, skip_normalize=fuse_norm)
+                p_reps = self.encode_passage(passage, skip_normalize=fuse_norm)
+        # print(teacher_score)
+        # assert 1 > 2
+        # if self.loss_type == "multi-softma" or "myloss":
+        # assert teacher_score == None
+        # for inference
+        if q_reps is None or p_reps is None:  # 如果有一个为None，说明是用模型来编码
+            return EncoderOutput(
+                q_reps=q_reps,
+                p_reps=p_reps,
+                loss=None,
+                scores=None
+            )
+
+        if self.training:
+            if self.negatives_x_device:
+                # 三个gather先全部异步发出去互相重叠，也和本地的kernel排队重叠，之后统一wait
+                q_gathered = self._gather_async(q_reps, 'q')
+                p_gathered = self._gather_async(p_reps, 'p')
+                t_gathered = self._gather_async(teacher_score, 'teacher')
+                q_reps = self._gather_wait(q_gathered)
+                p_reps = self._gather_wait(p_gathered)
+                teacher_score = self._gather_wait(t_gathered)
+
+            scores, loss = self._contrastive_tail(q_reps, p_reps, teacher_score, fuse_norm)
+        else:
+            scores = self.compute_similarity(q_reps, p_reps)
+            loss = None
+        return EncoderOutput(
+            loss=loss,
+            scores=scores,
+            q_reps=q_reps,
+            p_reps=p_reps,
+        )
+
+    def _contrastive_tail(self, q_reps, p_reps, teacher_score, fuse_norm: bool = False):
+        # gather之后纯tensor计算的尾巴，单独拆出来方便torch.compile整段融合（encoder前向不进编译图）
+        # 温度折进GEMM：给q先乘1/T，省掉对B×(B*N)矩阵的一次除法pass
+        scores = self.compute_similarity(q_reps * self.inv_temperature, p_reps)
+        scores = scores.float()  # loss在FP32下算，保证softmax/log数值稳定
+        if fuse_norm:
+            # rsqrt范数外积一次缩放score矩阵，结果等价cosine，省掉两次B×D的normalize写回；
+            # 平方范数clamp到1e-24（即范数1e-12），对齐F.normalize的eps，全零向量不会出inf
+            q_inv_norm = torch.rsqrt(q_reps.float().pow(2).sum(-1).clamp_min(1e-24))
+            p_inv_norm = torch.rsqrt(p_reps.float().pow(2).sum(-1).clamp_min(1e-24))
+            scores = scores * (q_inv_norm.unsqueeze(1) * p_inv_norm.unsqueeze(0))
+        scores = scores.view(q_reps.size(0), -1)
+
+        if teacher_score is not None:
+            # 多个正样本，每个query的正负样本由teacher score指出
+            # 正例固定在块对角线[i, i*N:(i+1)*N]上，直接往对角线copy，省掉arange和scatter
+            B, N = teacher_score.shape
+            target = scores.new_zeros(B, B * N, dtype=torch.float32)
+            target.view(B, B, N).diagonal(dim1=0, dim2=1).copy_(teacher_score.t())
+        else:
+            target = torch.arange(scores.size(0), device=scores.device, dtype=torch.long)
+            target = target * (p_reps.size(0) // q_reps.size(0))
+
+        loss = self.compute_loss(scores, target)
+        return scores, loss
+
+    # def compute_loss(self, scores, target):
+    #     return self.cross_entropy(scores, target)
+
+    def _gather_async(self, t: Optional[torch.Tensor], role: str = 'shared'):
+        if t is None:
+            return None
+        t = t.contiguous()
+
+        # 按(调用角色, shape, dtype)复用预分配的连续buffer，shape变化时才重新分配。
+        # 角色必须进key：q和p的shape可能相同（如train_group_size=1），
+        # 只按shape缓存会让同时存活的两个gather写同一块buffer，互相覆盖
+        key = (role, t.shape, t.dtype)
+        all_tensors = self._gather_cache.get(key)
+        if all_tensors is None or all_tensors.device != t.device:
+            all_tensors = torch.empty(self.world_size * t.size(0), *t.shape[1:], dtype=t.dtype, device=t.device)
+            self._gather_cache[key] = all_tensors
+        # 同一块buffer上不允许有未wait的collective，否则两次gather并发写会racy地互相覆盖
+        assert key not in self._gather_inflight, f'gather buffer {key} already has an outstanding all_gather'
+        self._gather_inflight.add(key)
+        # detach切断上一步copy_留下的grad_fn，避免buffer跨step挂住旧计算图
+        all_tensors = all_tensors.detach()
+        # async_op发起非阻塞collective，NCCL通信和本地计算重叠，调用方攒齐后统一wait
+        handle = dist.all_gather(list(all_tensors.chunk(self.world_size)), t, async_op=True)
+        return all_tensors, handle, t, key
+
+    def _gather_wait(self, gathered):
+        if gathered is None:
+            return None
+        all_tensors, handle, t, key = gathered
+        handle.wait()
+        self._gather_inflight.discard(key)
+        # 将当前进程的tensor原地写回对应的位置，保证本地梯度能够回传
+        all_tensors.narrow(0, self.process_rank * t.size(0), t.size(0)).copy_(t)
+        return all_tensors
+
+    def _dist_gather_tensor(self, t: Optional[torch.Tensor], role: str = 'shared'):
+        return self._gather_wait(self._gather_async(t, role))
+
+    @classmethod
+    def build(
+            cls,
+            model_args: ModelArguments,
+            train_args: TrainingArguments,
+            **hf_kwargs,
+    ):
+        # load local
+        if os.path.isdir(model_args.model_name_or_path):
+            if model_args.untie_encoder:
+
+                _qry_model_path = os.path.join(model_args.model_name_or_path, 'query_model')
+                _psg_model_path = os.path.join(model_args.model_name_or_path, 'passage_model')
+                if not os.path.exists(_qry_model_path):
+                    _qry_model_path = model_args.model_name_or_path
+                    _psg_model_path = model_args.model_name_or_path
+                logger.info(f'loading query model weight from {_qry_model_path}')
+                lm_q = cls.TRANSFORMER_CLS.from_pretrained(
+                    _qry_model_path,
+                    **hf_kwargs
+                )
+                logger.info(f'loading passage model weight from {_psg_model_path}')
+                lm_p = cls.TRANSFORMER_CLS.from_pretrained(
+                    _psg_model_path,
+                    **hf_kwargs
+                )
+            else:
+                lm_q = cls.TRANSFORMER_CLS.from_pretrained(model_args.model_name_or_path, **hf_kwargs)
+                lm_p = lm_q
+        # load pre-trained
+        else:
+            lm_q = cls.TRANSFORMER_CLS.from_pretrained(model_args.model_name_or_path, **hf_kwargs)
+            # untie时直接再from_pretrained一份，deepcopy要走pickle协议且瞬时占双倍内存
+            lm_p = cls.TRANSFORMER_CLS.from_pretrained(model_args.model_name_or_path, **hf_kwargs) \
+                if model_args.untie_encoder else lm_q
+
+        if model_args.add_pooler:
+            pooler = cls.build_pooler(model_args)
+        else:
+            pooler = None
+
+        model = cls(
+            lm_q=lm_q,
+            lm_p=lm_p,
+            pooler=pooler,
+            negatives_x_device=train_args.negatives_x_device,
+            untie_encoder=model_args.untie_encoder,
+            normlized=model_args.normlized,
+            sentence_pooling_method=model_args.sentence_pooling_method,
+            temperature=train_args.temperature,
+            contrastive_loss_weight=train_args.contrastive_loss_weight,
+            loss_type=train_args.loss_type,
+            mixed_precision_dtype=None if model_args.mixed_precision_dtype == 'none'
+                else getattr(torch, model_args.mixed_precision_dtype),
+            gradient_checkpointing=train_args.gradient_checkpointing
+        )
+        return model
+
+    @classmethod
+    def load(
+            cls,
+            model_name_or_path,
+            normlized,
+            sentence_pooling_method,
+            quantize_pooler: bool = False,
+            **hf_kwargs,
+    ):
+        # load local
+        untie_encoder = True
+        if os.path.isdir(model_name_or_path):
+            _qry_model_path = os.path.join(model_name_or_path, 'query_model')
+            _psg_model_path = os.path.join(model_name_or_path, 'passage_model')
+            if os.path.exists(_qry_model_path):
+                logger.info(f'found separate weight for query/passage encoders')
+                logger.info(f'loading query model weight from {_qry_model_path}')
+                lm_q = cls.TRANSFORMER_CLS.from_pretrained(
+                    _qry_model_path,
+                    **hf_kwargs
+                )
+                logger.info(f'loading passage model weight from {_psg_model_path}')
+                lm_p = cls.TRANSFORMER_CLS.from_pretrained(
+                    _psg_model_path,
+                    **hf_kwargs
+                )
+                untie_encoder = False
+            else:
+                logger.info(f'try loading tied weight')
+                logger.info(f'loading model weight from {model_name_or_path}')
+                lm_q = cls.TRANSFORMER_CLS.from_pretrained(model_name_or_path, **hf_kwargs)
+                lm_p = lm_q
+        else:
+            logger.info(f'try loading tied weight')
+            logger.info(f'loading model weight from {model_name_or_path}')
+            lm_q = cls.TRANSFORMER_CLS.from_pretrained(model_name_or_path, **hf_kwargs)
+            lm_p = lm_q
+
+        pooler_weights = os.path.join(model_name_or_path, 'pooler.safetensors')
+        if not os.path.exists(pooler_weights):
+            pooler_weights = os.path.join(model_name_or_path, 'pooler.pt')
+        pooler_config = os.path.join(model_name_or_path, 'pooler_config.json')
+        if os.path.exists(pooler_weights) and os.path.exists(pooler_config):
+            logger.info(f'found pooler weight and configuration')
+            with open(pooler_config) as f:
+                pooler_config_dict = json.load(f)
+            pooler = cls.load_pooler(model_name_or_path, **pooler_config_dict)
+            if quantize_pooler:
+                pooler.quantize_for_inference()
+        else:
+            pooler = None
+
+        model = cls(
+            lm_q=lm_q,
+            lm_p=lm_p,
+            pooler=pooler,
+            untie_encoder=untie_encoder,
+            normlized=normlized,
+            sentence_pooling_method=sentence_pooling_method,
+        )
+        return model
+
+    def save(self, output_dir: str):
+        if self.untie_encoder:
+            os.makedirs(os.path.join(output_dir, 'query_model'))
+            os.makedirs(os.path.join(output_dir, 'passage_model'))
+            self.lm_q.save_pretrained(os.path.join(output_dir, 'query_model'))
+            self.lm_p.save_pretrained(os.path.join(output_dir, 'passage_model'))
+        else:
+            self.lm_q.save_pretrained(output_dir)
+        if self.pooler:
+            self.pooler.save_pooler(output_dir)
+
+
+class MultiBiEncoderModel(nn.Module):
+    TRANSFORMER_CLS = AutoModel
+
+    def __init__(self,
+                 lm_q: PreTrainedModel,
+                 lm_p: PreTrainedModel,
+                 pooler: nn.Module = None,
+                 untie_encoder: bool = False,
+                 normlized: bool = False,
+                 sentence_pooling_method: str = 'cls',
+                 negatives_x_device: bool = False,
+                 temperature: float = 1.0,
+                 contrastive_loss_weight: float = 1.0
+                 ):
+        super().__init__()
+        self.lm_q = lm_q
+        self.lm_p = lm_p
+        self.pooler = pooler
+        self.kl = nn.KLDivLoss(reduction="mean")
+        self.untie_encoder = untie_encoder
+
+        self.normlized = normlized
+        self.sentence_pooling_method = sentence_pooling_method
+        self.temperature = temperature
+        self.inv_temperature = 1.0 / temperature
+        self.negatives_x_device = negatives_x_device
+        self.contrastive_loss_weight = contrastive_loss_weight
+        if self.negatives_x_device:
+            if not dist.is_initialized():
+                raise ValueError('Distributed training has not been initialized for representation all gather.')
+            self.process_rank = dist.get_rank()
+            self.world_size = dist.get_world_size()
+            self._gather_cache = {}  # 按(role, shape, dtype)缓存gather buffer，batch shape固定时零分配
+            self._gather_inflight = set()  # 还没wait的gather对应的key，防止buffer被并发collective复用
+
+    def sentence_embedding(self, hidden_state, mask):
+        if self.sentence_pooling_method == 'mean':  # 使用所有token的平均值
+            # einsum直接做带mask的求和，不会materialize B*N*D的临时tensor
+            s = torch.einsum('bnd,bn->bd', hidden_state, mask.to(hidden_state.dtype))
+            # 计算每个句子的长度；长度和倒数保持fp32（bf16下>256的整数不可精确表示），乘回时再回到激活精度
+            d = mask.sum(dim=1, keepdim=True).clamp_min(1).float()
+            return s * d.reciprocal().to(hidden_state.dtype)
+        elif self.sentence_pooling_method == 'cls':  # 使用cls token
+            return hidden_state[:, 0]
+
+    def encode_passage(self, psg):
+        if psg is None:
+            return None
+        psg_out = self.lm_p(**psg, return_dict=True)
+        p_hidden = psg_out.last_hidden_state  # 取出最后一层的hidden state B * N * D
+        p_reps = self.sentence_embedding(p_hidden, psg['attention_mask'])
+        if self.pooler is not None:
+            p_reps = self.pooler(p=p_reps)  # D * d
+        if self.normlized:
+            p_reps = torch.nn.functional.normalize(p_reps, dim=-1)
+        # normalize/pooler的输出本身就是连续的，避免无条件contiguous引入一次全量拷贝
+        return p_reps if p_reps.is_contiguous() else p_reps.contiguous()
+
+    def encode_query(self, qry):
+        if qry is None:
+            return None
+        qry_out = self.lm_q(**qry, return_dict=True)
+        q_hidden = qry_out.last_hidden_state
+        q_reps = self.sentence_embedding(q_hidden, qry['attention_mask'])
+        if self.pooler is not None:
+            q_reps = self.pooler(q=q_reps)
+        if self.normlized:
+            q_reps = torch.nn.functional.normalize(q_reps, dim=-1)
+        return q_reps if q_reps.is_contiguous() else q_reps.contiguous()
+
+    def compute_similarity(self, q_reps, p_reps):
+        if len(p_reps.size()) == 2:  # 如果是单个句子，即没有batch维度
+            # 直接走mm的gemm路径，BLAS原生支持转置的RHS，不会退化到bmm
+            return torch.mm(q_reps, p_reps.t())
+        return torch.matmul(q_reps, p_reps.transpose(-2, -1))
+
+    @staticmethod
+    def load_pooler(model_weights_file, **config):
+        pooler = DensePooler(**config)
+        pooler.load(model_weights_file)
+        return pooler
+
+    @staticmethod
+    def build_pooler(model_args):
+        pooler = DensePooler(
+            model_args.projection_in_dim,
+            model_args.projection_out_dim,
+            tied=not model_args.untie_encoder
+        )
+        pooler.load(model_args.model_name_or_path)
+        return pooler
+
+    def forward(self, query: Dict[str, Tensor] = None, passage: Dict[str, Tensor] = None, teacher_score: Tensor = None):
+        q_reps = self.encode_query(query)
+        p_reps = self.encode_passage(passage)
+
+        # for inference
+        if q_reps is None or p_reps is None:  # 如果有一个为None，说明是用模型来编码
+            return EncoderOutput(
+                q_reps=q_reps,
+                p_reps=p_reps,
+                loss=None,
+                scores=None
+            )
+
+        if self.training:
+            if self.negatives_x_device:
+                # 两个gather先异步发出去互相重叠，之后统一wait
+                q_gathered = self._gather_async(q_reps, 'q')
+                p_gathered = self._gather_async(p_reps, 'p')
+                q_reps = self._gather_wait(q_gathered)
+                p_reps = self._gather_wait(p_gathered)
+
+            # 温度折进GEMM：给q先乘1/T，省掉对B×(B*N)矩阵的一次除法pass
+            scores = self.compute_similarity(q_reps * self.inv_temperature, p_reps)
+            scores = scores.view(q_reps.size(0), -1)
+
+            # 多个正样本，每个query的正负样本由teacher score指出
+            # 正例固定在块对角线[i, i*N:(i+1)*N]上，直接往对角线copy，省掉arange和scatter
+            B, N = teacher_score.shape
+            target = scores.new_zeros(B, B * N, dtype=torch.float32)
+            target.view(B, B, N).diagonal(dim1=0, dim2=1).copy_(teacher_score.t())
+            # # 设置正负样本的weight为比例的倒数，正样本为总数除以正样本数，负样本为总数除以负样本数
+            # # 一次broadcast算完，不要按行跑Python循环（O(B)次kernel launch且CPU串行）
+            # num_pos = target.sum(dim=1, keepdim=True)
+            # num_neg = target.size(1) - num_pos
+            # weights = torch.where(target.bool(),
+            #                       target.size(1) / num_pos.clamp_min(1),
+            #                       target.size(1) / num_neg.clamp_min(1))
+
+            loss = self.compute_loss(scores, target)
+
+        else:
+            scores = self.compute_similarity(q_reps, p_reps)
+            loss = None
+        return EncoderOutput(
+            loss=loss,
+            scores=scores,
+            q_reps=q_reps,
+            p_reps=p_reps,
+        )
+
+    def compute_loss(self, scores, target, weights=None):
+        # scores: B * (B * N), target: B * (B * N)
+        # loss = nn.BCEWithLogitsLoss(weight=weights)(scores, target)
+
+        # loss = -log(sum(exp(positives) / sum(exp(all)))
+        # target indicates the position of positive samples, 1 for positive, 0 for negative
+        # valid_mask = target.sum(dim=1) > 0
+        # valid_scores = scores[valid_mask]
+        # valid_target = target[valid_mask]
+        # if valid_scores.size(0) == 0:
+        #     return torch.tensor(0.0, device=scores.device, requires_grad=True)
+
+        # soft_scores = F.softmax(valid_scores, dim=-1)
+        # sum_positives = torch.sum(soft_scores * valid_target, dim=-1)
+        # log_sum_scores = -torch.log(sum_positives)
+        # loss = torch.mean(log_sum_scores)
+
+        # hinge embedding loss：正例贡献d=1-score，负例贡献max(0, margin-d)
+        # 用布尔mask+where一次融合算完，不再需要*2-1变换和两次flatten拷贝
+        positive = target.bool()
+        distance = 1 - scores
+        loss = torch.where(positive, distance, torch.clamp_min(0.5 - distance, 0)).mean()
+
+        return loss
+    
+    def _gather_async(self, t: Optional[torch.Tensor], role: str = 'shared'):
+        if t is None:
+            return None
+        t = t.contiguous()
+
+        # 按(调用角色, shape, dtype)复用预分配的连续buffer，shape变化时才重新分配。
+        # 角色必须进key：q和p的shape可能相同（如train_group_size=1），
+        # 只按shape缓存会让同时存活的两个gather写同一块buffer，互相覆盖
+        key = (role, t.shape, t.dtype)
+        all_tensors = self._gather_cache.get(key)
+        if all_tensors is None or all_tensors.device != t.device:
+            all_tensors = torch.empty(self.world_size * t.size(0), *t.shape[1:], dtype=t.dtype, device=t.device)
+            self._gather_cache[key] = all_tensors
+        # 同一块buffer上不允许有未wait的collective，否则两次gather并发写会racy地互相覆盖
+        assert key not in self._gather_inflight, f'gather buffer {key} already has an outstanding all_gather'
+        self._gather_inflight.add(key)
+        # detach切断上一步copy_留下的grad_fn，避免buffer跨step挂住旧计算图
+        all_tensors = all_tensors.detach()
+        # async_op发起非阻塞collective，NCCL通信和本地计算重叠，调用方攒齐后统一wait
+        handle = dist.all_gather(list(all_tensors.chunk(self.world_size)), t, async_op=True)
+        return all_tensors, handle, t, key
+
+    def _gather_wait(self, gathered):
+        if gathered is None:
+            return None
+        all_tensors, handle, t, key = gathered
+        handle.wait()
+        self._gather_inflight.discard(key)
+        # 将当前进程的tensor原地写回对应的位置，保证本地梯度能够回传
+        all_tensors.narrow(0, self.process_rank * t.size(0), t.size(0)).copy_(t)
+        return all_tensors
+
+    def _dist_gather_tensor(self, t: Optional[torch.Tensor], role: str = 'shared'):
+        return self._gather_wait(self._gather_async(t, role))
+
+    @classmethod
+    def build(
+            cls,
+            model_args: ModelArguments,
+            train_args: TrainingArguments,
+            **hf_kwargs,
+    ):
+        # load local
+        if os.path.isdir(model_args.model_name_or_path):
+            if model_args.untie_encoder:
+
+                _qry_model_path = os.path.join(model_args.model_name_or_path, 'query_model')
+                _psg_model_path = os.path.join(model_args.model_name_or_path, 'passage_model')
+                if not os.path.exists(_qry_model_path):
+                    _qry_model_path = model_args.model_name_or_path
+                    _psg_model_path = model_args.model_name_or_path
+                logger.info(f'loading query model weight from {_qry_model_path}')
+                lm_q = cls.TRANSFORMER_CLS.from_pretrained(
+                    _qry_model_path,
+                    **hf_kwargs
+                )
+                logger.info(f'loading passage model weight from {_psg_model_path}')
+                lm_p = cls.TRANSFORMER_CLS.from_pretrained(
+                    _psg_model_path,
+                    **hf_kwargs
+                )
+            else:
+                lm_q = cls.TRANSFORMER_CLS.from_pretrained(model_args.model_name_or_path, **hf_kwargs)
+                lm_p = lm_q
+        # load pre-trained
+        else:
+            lm_q = cls.TRANSFORMER_CLS.from_pretrained(model_args.model_name_or_path, **hf_kwargs)
+            # untie时直接再from_pretrained一份，deepcopy要走pickle协议且瞬时占双倍内存
+            lm_p = cls.TRANSFORMER_CLS.from_pretrained(model_args.model_name_or_path, **hf_kwargs) \
+                if model_args.untie_encoder else lm_q
+
+        if model_args.add_pooler:
+            pooler = cls.build_pooler(model_args)
+        else:
+            pooler = None
+
+        model = cls(
+            lm_q=lm_q,
+            lm_p=lm_p,
+            pooler=pooler,
+            negatives_x_device=train_args.negatives_x_device,
+            untie_encoder=model_args.untie_encoder,
+            normlized=model_args.normlized,
+            sentence_pooling_method=model_args.sentence_pooling_method,
+            temperature=train_args.temperature,
+            contrastive_loss_weight=train_args.contrastive_loss_weight,
+            loss_type=train_args.loss_type
+        )
+        return model
+
+    @classmethod
+    def load(
+            cls,
+            model_name_or_path,
+            normlized,
+            sentence_pooling_method,
+            **hf_kwargs,
+    ):
+        # load local
+        untie_encoder = True
+        if os.path.isdir(model_name_or_path):
+            _qry_model_path = os.path.join(model_name_or_path, 'query_model')
+            _psg_model_path = os.path.join(model_name_or_path, 'passage_model')
+            if os.path.exists(_qry_model_path):
+                logger.info(f'found separate weight for query/passage encoders')
+                logger.info(f'loading query model weight from {_qry_model_path}')
+                lm_q = cls.TRANSFORMER_CLS.from_pretrained(
+                    _qry_model_path,
+                    **hf_kwargs
+                )
+                logger.info(f'loading passage model weight from {_psg_model_path}')
+                lm_p = cls.TRANSFORMER_CLS.from_pretrained(
+                    _psg_model_path,
+                    **hf_kwargs
+                )
+                untie_encoder = False
+            else:
+                logger.info(f'try loading tied weight')
+                logger.info(f'loading model weight from {model_name_or_path}')
+                lm_q = cls.TRANSFORMER_CLS.from_pretrained(model_name_or_path, **hf_kwargs)
+                lm_p = lm_q
+        else:
+            logger.info(f'try loading tied weight')
+            logger.info(f'loading model weight from {model_name_or_path}')
+            lm_q = cls.TRANSFORMER_CLS.from_pretrained(model_name_or_path, **hf_kwargs)
+            lm_p = lm_q
+
+        pooler_weights = os.path.join(model_name_or_path, 'pooler.safetensors')
+        if not os.path.exists(pooler_weights):
+            pooler_weights = os.path.join(model_name_or_path, 'pooler.pt')
+        pooler_config = os.path.join(model_name_or_path, 'pooler_config.json')
+        if os.path.exists(pooler_weights) and os.path.exists(pooler_config):
+            logger.info(f'found pooler weight and configuration')
+            with open(pooler_config) as f:
+                pooler_config_dict = json.load(f)
+            pooler = cls.load_pooler(model_name_or_path, **pooler_config_dict)
+        else:
+            pooler = None
+
+        model = cls(
+            lm_q=lm_q,
+            lm_p=lm_p,
+            pooler=pooler,
+            untie_encoder=untie_encoder,
+            normlized=normlized,
+            sentence_pooling_method=sentence_pooling_method,
+        )
+        return model
+
+    def save(self, output_dir: str):
+        if self.untie_encoder:
+            os.makedirs(os.path.join(output_dir, 'query_model'))
+            os.makedirs(os.path.join(output_dir, 'passage_model'))
+            self.lm_q.save_pretrained(os.path.join(output_dir, 'query_model'))
+            self.lm_p.save_pretrained(os.path.join(output_dir, 'passage_model'))
+        else:
+            self.lm_q.save_pretrained(output_dir)
+        if self.pooler:
+            self.pooler.save_pooler(output_dir)